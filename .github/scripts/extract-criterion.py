@@ -18,9 +18,21 @@ Usage:
 """
 
 import argparse
+import functools
+import io
 import json
+import math
 import os
+import re
 import sys
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
 
 try:
     import matplotlib
@@ -32,12 +44,35 @@ try:
 except ImportError:
     HAS_MATPLOTLIB = False
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj, indent=2).encode()
+
 # Only track rtmalloc variants in the dashboard (not system/mimalloc).
-TRACKED_ALLOCATORS = {"rt_nightly", "rt_std", "rt_nostd", "rt_percpu"}
+TRACKED_ALLOCATORS = frozenset({"rt_nightly", "rt_std", "rt_nostd", "rt_percpu"})
 
 # Threshold for flagging regressions/improvements in PR comments.
 CHANGE_THRESHOLD = 0.05  # 5%
 
+# Above this many estimates, decode in worker processes instead of threads
+# (process startup dominates on smaller trees).
+PROCESS_POOL_THRESHOLD = 2000
+
+# Matches the top-level median.point_estimate in a criterion estimates.json.
+# The median object nests a confidence_interval object, so allow one level of
+# braces inside it (but never match a point_estimate within that nesting).
+_MEDIAN_RE = re.compile(
+    rb'"median"\s*:\s*\{(?:[^{}]|\{[^{}]*\})*?"point_estimate"\s*:\s*(-?[0-9][0-9eE.+-]*)'
+)
+
 # Canonical allocator ordering (matches KNOWN in alloc_bench.rs).
 ALLOCATOR_ORDER = [
     "system",
@@ -81,46 +116,135 @@ ALLOCATOR_LABELS = {
 }
 
 
-def scan_criterion_dir(criterion_path):
-    """Walk a criterion output directory and collect median estimates.
+def _find_estimate_files(criterion_path, filter_allocators=None):
+    """Collect (benchmark name, estimates.json path) pairs under a criterion directory.
+
+    Only estimates in "new" subdirectories are returned (criterion stores
+    base/new); those directories are not descended into.
+    e.g. criterion_path/single_alloc_dealloc/rt_nightly/8/new/estimates.json
+      -> ("single_alloc_dealloc/rt_nightly/8", ".../8/new/estimates.json")
+
+    If filter_allocators is given, group/allocator subtrees whose allocator is
+    not in it are skipped entirely.
+    """
+    leaves = []
+    estimates_suffix = os.sep + "estimates.json"
+    # Iterative DFS over (directory, benchmark name so far, depth). Names and
+    # paths are extended by plain string concatenation as we descend.
+    stack = [(criterion_path, "", 0)]
+    while stack:
+        path, name, depth = stack.pop()
+        try:
+            it = os.scandir(path)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                if entry.name == "new":
+                    leaves.append((name, entry.path + estimates_suffix))
+                    continue
+                # Depth 1 children are the allocator component of group/allocator
+                if (filter_allocators is not None and depth == 1
+                        and entry.name not in filter_allocators):
+                    continue
+                child = f"{name}/{entry.name}" if name else entry.name
+                stack.append((entry.path, child, depth + 1))
+    return leaves
+
+
+def _read_estimate(leaf):
+    """Read the median estimate for a (name, estimates.json path) pair.
+
+    Returns (name, median_ns), or None if the estimate is missing or unreadable.
+    """
+    name, path = leaf
+    try:
+        with open(path, "rb") as f:
+            raw = f.read()
+    except OSError:
+        return None
+
+    # Only one field is needed, so pull it straight out of the raw bytes and
+    # fall back to a full parse if the layout is not what we expect.
+    m = _MEDIAN_RE.search(raw)
+    if m:
+        try:
+            return (name, float(m.group(1)))
+        except ValueError:
+            pass
+
+    try:
+        data = _json_loads(raw)
+    except ValueError:
+        return None
+
+    median_ns = data.get("median", {}).get("point_estimate")
+    if median_ns is None:
+        return None
+    return (name, median_ns)
+
+
+def _scan_chunk(leaves):
+    """Read a chunk of (name, estimates.json path) pairs in a worker process.
 
     Returns dict mapping benchmark name -> median nanoseconds.
-    Benchmark names look like "group/allocator/param" or "group/allocator".
     """
     results = {}
-    for root, dirs, files in os.walk(criterion_path):
-        if "estimates.json" not in files:
-            continue
-        # Only look at the "new" subdirectory (criterion stores base/new)
-        if os.path.basename(root) != "new":
-            continue
+    for leaf in leaves:
+        item = _read_estimate(leaf)
+        if item is not None:
+            name, median_ns = item
+            results[name] = median_ns
+    return results
 
-        estimates_path = os.path.join(root, "estimates.json")
-        try:
-            with open(estimates_path) as f:
-                data = json.load(f)
-        except (json.JSONDecodeError, OSError):
-            continue
 
-        median_ns = data.get("median", {}).get("point_estimate")
-        if median_ns is None:
-            continue
+def _available_cpus():
+    """Number of CPUs this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # sched_getaffinity is Linux-only
+        return os.cpu_count() or 1
 
-        # Build the benchmark name from the path relative to criterion_path.
-        # e.g. criterion_path/single_alloc_dealloc/rt_nightly/8/new/estimates.json
-        #   -> single_alloc_dealloc/rt_nightly/8
-        rel = os.path.relpath(root, criterion_path)
-        # Remove trailing "/new"
-        parts = rel.replace("\\", "/").split("/")
-        if parts and parts[-1] == "new":
-            parts = parts[:-1]
-        name = "/".join(parts)
 
-        results[name] = median_ns
+def scan_criterion_dir(criterion_path, filter_allocators=None):
+    """Walk a criterion output directory and collect median estimates.
+
+    Returns dict mapping benchmark name -> median nanoseconds.
+    Benchmark names look like "group/allocator/param" or "group/allocator".
+    If filter_allocators is given, only those allocators' subtrees are read.
+    """
+    leaves = _find_estimate_files(criterion_path, filter_allocators)
+    results = {}
+    if not leaves:
+        return results
+
+    # Very large trees make decoding CPU-bound: hand one contiguous chunk to
+    # each available CPU and merge the per-chunk dicts in order.
+    if len(leaves) > PROCESS_POOL_THRESHOLD:
+        n_workers = _available_cpus()
+        chunk_size = -(-len(leaves) // n_workers)
+        chunks = [leaves[i:i + chunk_size] for i in range(0, len(leaves), chunk_size)]
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            for chunk_results in pool.map(_scan_chunk, chunks):
+                results.update(chunk_results)
+        return results
+
+    # Otherwise reading estimates is syscall-bound (open/read/close release
+    # the GIL), so fan the reads out over a thread pool.
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for item in pool.map(_read_estimate, leaves):
+            if item is not None:
+                name, median_ns = item
+                results[name] = median_ns
 
     return results
 
 
+@functools.lru_cache(maxsize=None)
 def extract_allocator(name):
     """Extract the allocator name from a benchmark name like 'group/allocator/param'."""
     parts = name.split("/")
@@ -147,16 +271,29 @@ def is_tracked(name):
     return extract_allocator(name) in TRACKED_ALLOCATORS
 
 
+# (divisor, format) per power of 1000, indexed by int(log10(ns)) // 3.
+_NS_SCALES = (
+    (1, "{:.1f} ns"),
+    (1_000, "{:.2f} us"),
+    (1_000_000, "{:.2f} ms"),
+    (1_000_000_000, "{:.2f} s"),
+)
+
+
+@functools.lru_cache(maxsize=4096)
 def format_ns(ns):
     """Format nanoseconds into a human-readable string."""
-    if ns < 1_000:
-        return f"{ns:.1f} ns"
-    elif ns < 1_000_000:
-        return f"{ns / 1_000:.2f} us"
-    elif ns < 1_000_000_000:
-        return f"{ns / 1_000_000:.2f} ms"
+    if ns < 1:
+        idx = 0
+    elif ns < math.inf:
+        idx = min(3, int(math.log10(ns)) // 3)
+        # log10 may round up to the next integer just below a power of 1000
+        if ns < _NS_SCALES[idx][0]:
+            idx -= 1
     else:
-        return f"{ns / 1_000_000_000:.2f} s"
+        idx = 3
+    divisor, fmt = _NS_SCALES[idx]
+    return fmt.format(ns / divisor)
 
 
 def to_benchmark_json(results):
@@ -164,15 +301,19 @@ def to_benchmark_json(results):
 
     Only includes tracked rtmalloc allocator variants.
     """
+    tracked = TRACKED_ALLOCATORS
     entries = []
-    for name in sorted(results.keys()):
-        if not is_tracked(name):
+    for name, median_ns in results.items():
+        if extract_allocator(name) not in tracked:
             continue
         entries.append({
             "name": name,
             "unit": "ns",
-            "value": round(results[name], 2),
+            "value": round(median_ns, 2),
         })
+    # Walk order depends on the filesystem; sort only the kept entries so the
+    # output stays stable and diff-friendly.
+    entries.sort(key=lambda e: e["name"])
     return entries
 
 
@@ -181,93 +322,147 @@ def to_bmf_json(results):
 
     Only includes tracked rtmalloc allocator variants.
     """
+    tracked = TRACKED_ALLOCATORS
     bmf = {}
     for name in sorted(results.keys()):
-        if not is_tracked(name):
+        if extract_allocator(name) not in tracked:
             continue
         bmf[name] = {"latency": {"value": round(results[name], 2)}}
     return bmf
 
 
+def _classify_changes(names, base_results, head_results, split_names):
+    """Compute (name, base_ns, head_ns, change) entries for benchmarks in both runs.
+
+    split_names maps each name to its (group, allocator, param) components.
+    Returns (groups, improved, regressed, unchanged): groups maps each group
+    name to its entries in the order of names, and the other three partition
+    the entries by CHANGE_THRESHOLD. A base of 0 counts as unchanged with a
+    change of 0.0.
+    """
+    groups = {}
+
+    if HAS_NUMPY:
+        n = len(names)
+        base_arr = np.fromiter((base_results[name] for name in names), dtype=np.float64, count=n)
+        head_arr = np.fromiter((head_results[name] for name in names), dtype=np.float64, count=n)
+        change = np.zeros(n, dtype=np.float64)
+        np.divide(head_arr - base_arr, base_arr, out=change, where=base_arr != 0)
+
+        entries = []
+        for name, c in zip(names, change.tolist()):
+            entry = (name, base_results[name], head_results[name], c)
+            entries.append(entry)
+            groups.setdefault(split_names[name][0], []).append(entry)
+        improved_mask = change < -CHANGE_THRESHOLD
+        regressed_mask = change > CHANGE_THRESHOLD
+        unchanged_mask = ~(improved_mask | regressed_mask)
+        return (
+            groups,
+            [entries[i] for i in np.flatnonzero(improved_mask)],
+            [entries[i] for i in np.flatnonzero(regressed_mask)],
+            [entries[i] for i in np.flatnonzero(unchanged_mask)],
+        )
+
+    improved = []
+    regressed = []
+    unchanged = []
+    for name in names:
+        base_ns = base_results[name]
+        head_ns = head_results[name]
+
+        if base_ns == 0:
+            entry = (name, base_ns, head_ns, 0.0)
+            unchanged.append(entry)
+        else:
+            change = (head_ns - base_ns) / base_ns
+
+            entry = (name, base_ns, head_ns, change)
+            if change < -CHANGE_THRESHOLD:
+                improved.append(entry)
+            elif change > CHANGE_THRESHOLD:
+                regressed.append(entry)
+            else:
+                unchanged.append(entry)
+
+        groups.setdefault(split_names[name][0], []).append(entry)
+    return groups, improved, regressed, unchanged
+
+
 def generate_comparison_comment(base_results, head_results):
     """Generate a Markdown comparison comment for a PR."""
     # Collect all benchmark names present in either run
     all_names = sorted(set(base_results.keys()) | set(head_results.keys()))
 
-    improved = []
-    regressed = []
-    unchanged = []
+    # Split each name once into (group, allocator, param); everything below
+    # (grouping, tracked filters, table rows) reads from this.
+    tracked_allocators = TRACKED_ALLOCATORS
+    split_names = {}
+    for name in all_names:
+        parts = name.split("/")
+        split_names[name] = (
+            parts[0],
+            parts[1] if len(parts) >= 2 else parts[0],
+            parts[2] if len(parts) >= 3 else "-",
+        )
+    tracked = {
+        name for name, (_, allocator, _) in split_names.items()
+        if allocator in tracked_allocators
+    }
+
     new_benchmarks = []
     removed_benchmarks = []
+    common = []
 
     for name in all_names:
         if name not in base_results:
             new_benchmarks.append(name)
-            continue
-        if name not in head_results:
+        elif name not in head_results:
             removed_benchmarks.append(name)
-            continue
-
-        base_ns = base_results[name]
-        head_ns = head_results[name]
-
-        if base_ns == 0:
-            unchanged.append((name, base_ns, head_ns, 0.0))
-            continue
-
-        change = (head_ns - base_ns) / base_ns
-
-        entry = (name, base_ns, head_ns, change)
-        if change < -CHANGE_THRESHOLD:
-            improved.append(entry)
-        elif change > CHANGE_THRESHOLD:
-            regressed.append(entry)
         else:
-            unchanged.append(entry)
+            common.append(name)
 
-    # Build the Markdown
-    lines = ["## Benchmark Comparison\n"]
+    # Groups are filled in sorted name order, so each group's entries are
+    # already sorted.
+    groups, improved, regressed, unchanged = _classify_changes(
+        common, base_results, head_results, split_names
+    )
+
+    # Build the Markdown directly into a single buffer
+    buf = io.StringIO()
+    buf.write("## Benchmark Comparison\n\n")
 
     # Separate rtmalloc-only stats
-    rt_improved = [e for e in improved if is_tracked(e[0])]
-    rt_regressed = [e for e in regressed if is_tracked(e[0])]
-    rt_unchanged = [e for e in unchanged if is_tracked(e[0])]
-
-    lines.append(
-        f"**rtmalloc variants:** "
-        f"{'✅ ' + str(len(rt_improved)) + ' improved, ' if rt_improved else ''}"
-        f"{'⚠️ ' + str(len(rt_regressed)) + ' regressed, ' if rt_regressed else ''}"
-        f"{len(rt_unchanged)} unchanged "
-        f"(>{int(CHANGE_THRESHOLD * 100)}% threshold)\n"
-    )
+    rt_improved = [e for e in improved if e[0] in tracked]
+    rt_regressed = [e for e in regressed if e[0] in tracked]
+    rt_unchanged = [e for e in unchanged if e[0] in tracked]
 
+    buf.write("**rtmalloc variants:** ")
+    if rt_improved:
+        buf.write(f"✅ {len(rt_improved)} improved, ")
     if rt_regressed:
-        lines.append("> ⚠️ **Performance regressions detected in rtmalloc.** Please review below.\n")
+        buf.write(f"⚠️ {len(rt_regressed)} regressed, ")
+    buf.write(f"{len(rt_unchanged)} unchanged (>{int(CHANGE_THRESHOLD * 100)}% threshold)\n\n")
+
+    if rt_regressed:
+        buf.write("> ⚠️ **Performance regressions detected in rtmalloc.** Please review below.\n\n")
     elif rt_improved:
-        lines.append("> ✅ **Performance improvements detected!**\n")
+        buf.write("> ✅ **Performance improvements detected!**\n\n")
     else:
-        lines.append("> No significant changes in rtmalloc variants.\n")
+        buf.write("> No significant changes in rtmalloc variants.\n\n")
 
-    # Group benchmarks by group name (first path component)
-    groups = {}
-    all_entries = improved + regressed + unchanged
-    for entry in all_entries:
-        name = entry[0]
-        group = name.split("/")[0]
-        groups.setdefault(group, []).append(entry)
+    buf.write("<details><summary>Full results</summary>\n\n")
 
-    lines.append("<details><summary>Full results</summary>\n")
+    for group, group_entries in sorted(groups.items()):
+        # Collect the whole table for this group and emit it in one write
+        rows = [
+            f"### {group}\n",
+            "| Allocator | Param | Base | Head | Change |",
+            "|-----------|-------|-----:|-----:|-------:|",
+        ]
 
-    for group in sorted(groups.keys()):
-        entries = sorted(groups[group], key=lambda e: e[0])
-        lines.append(f"### {group}\n")
-        lines.append("| Allocator | Param | Base | Head | Change |")
-        lines.append("|-----------|-------|-----:|-----:|-------:|")
-
-        for name, base_ns, head_ns, change in entries:
-            parts = name.split("/")
-            allocator = parts[1] if len(parts) >= 2 else parts[0]
-            param = parts[2] if len(parts) >= 3 else "-"
+        for name, base_ns, head_ns, change in group_entries:
+            _, allocator, param = split_names[name]
 
             change_str = f"{change:+.1%}"
             if change > CHANGE_THRESHOLD:
@@ -275,30 +470,31 @@ def generate_comparison_comment(base_results, head_results):
             elif change < -CHANGE_THRESHOLD:
                 change_str += " ✅"
 
-            lines.append(
-                f"| {allocator} | {param} "
-                f"| {format_ns(base_ns)} | {format_ns(head_ns)} "
-                f"| {change_str} |"
-            )
+            rows.append("".join((
+                "| ", allocator, " | ", param,
+                " | ", format_ns(base_ns), " | ", format_ns(head_ns),
+                " | ", change_str, " |",
+            )))
 
-        lines.append("")
+        buf.write("\n".join(rows))
+        buf.write("\n\n")
 
     if new_benchmarks:
-        lines.append("### New benchmarks\n")
+        buf.write("### New benchmarks\n\n")
         for name in new_benchmarks:
             if name in head_results:
-                lines.append(f"- **{name}**: {format_ns(head_results[name])}")
-        lines.append("")
+                buf.write(f"- **{name}**: {format_ns(head_results[name])}\n")
+        buf.write("\n")
 
     if removed_benchmarks:
-        lines.append("### Removed benchmarks\n")
+        buf.write("### Removed benchmarks\n\n")
         for name in removed_benchmarks:
-            lines.append(f"- ~~{name}~~")
-        lines.append("")
+            buf.write(f"- ~~{name}~~\n")
+        buf.write("\n")
 
-    lines.append("</details>")
+    buf.write("</details>")
 
-    return "\n".join(lines)
+    return buf.getvalue()
 
 
 # ---------------------------------------------------------------------------
@@ -560,20 +756,23 @@ def main():
     parser.add_argument("--output-charts", help="Output directory for comparison chart SVGs")
     args = parser.parse_args()
 
-    head_results = scan_criterion_dir(args.head)
+    # Dashboard/BMF output only keeps tracked allocators, so the rest of the
+    # tree can be skipped unless charts or a comparison comment need it.
+    tracked_only = not (args.output_charts or args.output_comment)
+    head_results = scan_criterion_dir(
+        args.head, filter_allocators=TRACKED_ALLOCATORS if tracked_only else None
+    )
     if not head_results:
         print(f"Warning: no benchmark results found in {args.head}", file=sys.stderr)
 
     if args.output_json:
         entries = to_benchmark_json(head_results)
-        with open(args.output_json, "w") as f:
-            json.dump(entries, f, indent=2)
+        Path(args.output_json).write_bytes(_json_dumps(entries))
         print(f"Wrote {len(entries)} entries to {args.output_json}")
 
     if args.output_bmf:
         bmf = to_bmf_json(head_results)
-        with open(args.output_bmf, "w") as f:
-            json.dump(bmf, f, indent=2)
+        Path(args.output_bmf).write_bytes(_json_dumps(bmf))
         print(f"Wrote {len(bmf)} BMF entries to {args.output_bmf}")
 
     if args.output_charts:
@@ -584,12 +783,21 @@ def main():
         if not args.base:
             print("Error: --base is required when using --output-comment", file=sys.stderr)
             sys.exit(1)
-        base_results = scan_criterion_dir(args.base)
-        if not base_results:
-            print(f"Warning: no benchmark results found in {args.base}", file=sys.stderr)
-        comment = generate_comparison_comment(base_results, head_results)
-        with open(args.output_comment, "w") as f:
-            f.write(comment)
+        if any(is_tracked(name) for name in head_results):
+            base_results = scan_criterion_dir(args.base)
+            if not base_results:
+                print(f"Warning: no benchmark results found in {args.base}", file=sys.stderr)
+            comment = generate_comparison_comment(base_results, head_results)
+        else:
+            # Nothing to compare (e.g. the head benchmarks failed), so don't
+            # bother walking the base tree.
+            print(f"Warning: no tracked rtmalloc results in {args.head}, skipping {args.base}",
+                  file=sys.stderr)
+            comment = (
+                "## Benchmark Comparison\n\n"
+                "> ⚠️ **No tracked rtmalloc benchmark results found in this run.**"
+            )
+        Path(args.output_comment).write_bytes(comment.encode("utf-8"))
         print(f"Wrote comparison comment to {args.output_comment}")
 
 